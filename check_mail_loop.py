@@ -38,17 +38,28 @@
 #  due to the matter of *national* security concerns.
 # -----------------------------------------------------------------------------
 
-import smtplib
-import imaplib
-import argparse
+from __future__ import annotations
+
+import concurrent.futures
+import json
+import types
 import uuid
 import sys
 import os
+import re
+import select
+import socket
 import ssl
+import threading
 import time
-from email.mime.text import MIMEText
 from enum import Enum
-from typing import Optional
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+# The mail modules are imported where they are needed to keep the start-up time of the plugin low.
+if TYPE_CHECKING:
+	import argparse
+	import imaplib
+	import smtplib
 
 
 class MailFound(Enum):
@@ -67,38 +78,116 @@ delay = 10
 # number of times to search for token
 retries = 3
 
+# time between two checks in daemon mode
+interval = 60
+
+# file to remember the last seen UIDs between two checks
+state_file = "/var/cache/icinga_check_mail_loop/state.json"
+
+# number of mails to fetch with a single IMAP command
+fetch_batch_size = 100
+
+# matches the token line in the raw header or body of a mail
+_TOKEN_RE = re.compile(rb'^X-Icinga-Test-Id:\s*(\S+)', re.MULTILINE)
+
+# matches the UID in a FETCH response
+_UID_RE = re.compile(rb'\bUID (\d+)')
+
+# body of the test mail, with CRLF line endings as sent via SMTP
+_BODY_TEXT = ("Dear Icinga Monitoring Plugin,\r\n\r\n"
+			  "I hope your overall health is at its best. Today I am writing you another e-mail. I'm afraid you will\r\n"
+			  "take note of this email, maybe read out one or two bon mot and delete this mail. Maybe this is the way\r\n"
+			  "of things and we cannot change anything. The main thing is that everything is fine. I will write to\r\n"
+			  "you again very soon.\r\n\r\n"
+			  "Greetings\r\n\r\n"
+			  "The sender\r\n")
+
+
+# shared TLS context for SMTP and IMAP
+_SSL_CTX = None
+_ssl_ctx_lock = threading.Lock()
+
+# last TLS session per (host, port), used to resume sessions on reconnects
+_tls_sessions = {}
+
+
+class _ResumingSSLContext(ssl.SSLContext):
+	"""
+	TLS context that resumes the last TLS session to a server, which saves a full handshake when reconnecting.
+	"""
+
+	def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+					server_hostname=None, session=None):
+		if session is None and not server_side:
+			session = _tls_sessions.get((server_hostname, sock.getpeername()[1]))
+		return super().wrap_socket(sock, server_side=server_side, do_handshake_on_connect=do_handshake_on_connect,
+								   suppress_ragged_eofs=suppress_ragged_eofs, server_hostname=server_hostname,
+								   session=session)
+
+
+def _ssl_ctx() -> ssl.SSLContext:
+	"""
+	Create the TLS context on first use and reuse it afterwards, because loading the CA certificates is expensive.
+	The context is configured like ssl.create_default_context().
+
+	@return Function returns a ssl.SSLContext object.
+	"""
+	global _SSL_CTX
+
+	with _ssl_ctx_lock:
+		if _SSL_CTX is None:
+			_SSL_CTX = _ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+			_SSL_CTX.load_default_certs()
+
+			# Apply the remaining settings of ssl.create_default_context() here. Building a default context
+			# just to copy them would load the CA certificates a second time.
+			if sys.version_info >= (3, 13):
+				_SSL_CTX.verify_flags |= ssl.VERIFY_X509_PARTIAL_CHAIN | ssl.VERIFY_X509_STRICT
+			keylog_file = os.environ.get("SSLKEYLOGFILE")
+			if keylog_file and not sys.flags.ignore_environment and hasattr(_SSL_CTX, "keylog_filename"):
+				_SSL_CTX.keylog_filename = keylog_file
+		return _SSL_CTX
+
+
+def _tls_remember(sock: ssl.SSLSocket) -> None:
+	"""
+	Remember the TLS session of an established connection for later reconnects. As TLS 1.3 session tickets are
+	sent after the handshake, call this after the first exchange with the server, such as the login.
+
+	@param sock: The ssl.SSLSocket of the connection.
+	"""
+
+	if sock.session_reused:
+		debug(f"TLS: Resumed session to {sock.server_hostname}.")
+	if sock.session is not None:
+		_tls_sessions[sock.server_hostname, sock.getpeername()[1]] = sock.session
+
 
 def debug(message: str) -> None:
 	if debug_flag:
 		print(message)
 
 
-def email_create_message(mail_from: str, mail_to: str, _uuid: str) -> MIMEText:
+def email_create_message(mail_from: str, mail_to: str, _uuid: str) -> bytes:
 	"""
 	Create an E-mail.
 
 	@param mail_from: The sender's E-mail address for the E-mail header.
 	@param mail_to: The recipients E-mail address for the E-mail header.
 	@param _uuid: Add this UUID as additional X-Icinga-Test-Id header.
-	@return Function returns a MIMEText object.
+	@return Function returns the E-mail as bytes, ready to be passed to the SMTP DATA command.
 	"""
 
-	text = ("Dear Icinga Monitoring Plugin,\n\n"
-			"I hope your overall health is at its best. Today I am writing you another e-mail. I'm afraid you will\n"
-			"take note of this email, maybe read out one or two bon mot and delete this mail. Maybe this is the way\n"
-			"of things and we cannot change anything. The main thing is that everything is fine. I will write to\n"
-			"you again very soon.\n\n"
-			"Greetings\n\n"
-			"The sender\n")
-
-	msg = MIMEText(text)
-
-	msg["From"] = mail_from
-	msg["To"] = mail_to
-	msg["Subject"] = "Mail test"
-	msg["X-Icinga-Test-Id"] = _uuid
-
-	return msg
+	# The body is constant ASCII text, thus format the message directly instead of using the email package.
+	return (f"From: {mail_from}\r\n"
+			f"To: {mail_to}\r\n"
+			f"Subject: Mail test\r\n"
+			f"X-Icinga-Test-Id: {_uuid}\r\n"
+			f"MIME-Version: 1.0\r\n"
+			f"Content-Type: text/plain; charset=\"us-ascii\"\r\n"
+			f"Content-Transfer-Encoding: 7bit\r\n"
+			f"\r\n"
+			f"{_BODY_TEXT}").encode("ascii")
 
 
 def smtp_connect(smtp_host: str, smtp_port: int, smtp_user: str, smtp_pass: str) -> smtplib.SMTP:
@@ -112,185 +201,516 @@ def smtp_connect(smtp_host: str, smtp_port: int, smtp_user: str, smtp_pass: str)
 	@return Function returns a smtplib.SMTP object that represents a server connection.
 	"""
 
+	import smtplib
+
 	if smtp_port == 587:
 		server = smtplib.SMTP(smtp_host, smtp_port)
-		server.starttls()
+		server.starttls(context=_ssl_ctx())
 	else:
-		server = smtplib.SMTP_SSL(smtp_host, smtp_port, context=ssl.create_default_context())
+		server = smtplib.SMTP_SSL(smtp_host, smtp_port, context=_ssl_ctx())
 
 	debug(f"SMTP: Try to log in to {smtp_host} as: {smtp_user}")
 	server.login(smtp_user, smtp_pass)
 	debug(f"SMTP: Log in was successful.")
+	_tls_remember(server.sock)
 
 	return server
 
 
-def imap_retrieve_mail(imap_host: str, imap_port: int, imap_user: str, imap_pass: str, imap_spambox: Optional[str],
-					   expected_token: str, cleanup_flag: bool, search_body: bool) -> MailFound:
+def smtp_reconnect(server: Optional[smtplib.SMTP], smtp_host: str, smtp_port: int, smtp_user: str,
+				   smtp_pass: str) -> smtplib.SMTP:
 	"""
-	Retrieve an e-mail from an IMAP account. Search the INBOX and the Spambox for a specific token value.
-	Retry up to three times.
+	Reuse an existing SMTP connection if it is still alive, otherwise connect again.
+
+	@param server: A smtplib.SMTP object from a previous check or None.
+	@param smtp_host: The mail server host.
+	@param smtp_port: The SMTP server port. Plaintext communication is not supported.
+	@param smtp_user: The username for SMTP authentication.
+	@param smtp_pass: The password for SMTP authentication.
+	@return Function returns a smtplib.SMTP object that represents a server connection.
+	"""
+
+	import smtplib
+
+	if server is not None:
+		try:
+			if server.noop()[0] == 250:
+				return server
+		except (OSError, smtplib.SMTPException):
+			pass
+		debug(f"SMTP: Connection to {smtp_host} was lost.")
+
+	return smtp_connect(smtp_host, smtp_port, smtp_user, smtp_pass)
+
+
+def imap_connect(imap_host: str, imap_port: int, imap_user: str, imap_pass: str, mailbox: str,
+				 readonly: bool) -> imaplib.IMAP4_SSL:
+	"""
+	Connect to an IMAPS server and select a mailbox.
+
+	@param imap_host: The mail server host.
+	@param imap_port: The IMAP server port. STARTSSL or plaintext communication is not supported.
+	@param imap_user: The username for IMAP authentication.
+	@param imap_pass: The password for IMAP authentication.
+	@param mailbox: Name of the mailbox to select, such as INBOX or Junk.
+	@param readonly: Select the mailbox read-only, if no mails are going to be deleted.
+	@return Function returns an imaplib.IMAP4_SSL object that represents a server connection.
+	"""
+
+	import imaplib
 
+	server = imaplib.IMAP4_SSL(host=imap_host, port=imap_port, ssl_context=_ssl_ctx())
+	debug(f"IMAP: Try to log in to {imap_host} as: {imap_user}")
+	server.login(imap_user, imap_pass)
+	debug(f"IMAP: Log in was successful.")
+	_tls_remember(server.sock)
+
+	# imaplib only asks for the capabilities before the login, but many servers announce extensions such as
+	# IDLE and UNSELECT only afterwards.
+	typ, data = server.capability()
+	server.capabilities = tuple(data[-1].decode("ascii", "replace").upper().split())
+
+	# Keep the mailbox selected for all following searches.
+	typ, data = server.select(mailbox, readonly=readonly)
+	if typ != "OK":
+		server.logout()
+		raise imaplib.IMAP4.error(f"Cannot select mailbox {mailbox}: {data[-1].decode('utf-8', 'replace')}")
+
+	return server
+
+
+def imap_disconnect(server: imaplib.IMAP4, cleanup_flag: bool) -> None:
+	"""
+	Close the selected mailbox and log out from the IMAP server.
+
+	@param server: An imaplib.IMAP4 object that represents the sever connection.
+	@param cleanup_flag: Mails were deleted from the mailbox.
+	"""
+
+	# CLOSE implicitly expunges the mailbox on many servers. Avoid this work if nothing was deleted.
+	if cleanup_flag or "UNSELECT" not in server.capabilities:
+		server.close()
+	else:
+		server.unselect()
+	server.logout()
+
+
+def imap_reconnect(server: Optional[imaplib.IMAP4], imap_host: str, imap_port: int, imap_user: str, imap_pass: str,
+				   mailbox: str, readonly: bool) -> imaplib.IMAP4:
+	"""
+	Reuse an existing IMAP connection if it is still alive, otherwise connect again and select the mailbox.
+
+	@param server: An imaplib.IMAP4 object from a previous check or None.
 	@param imap_host: The mail server host.
-	@param imap_port: The SMTP server port. STARTSSL or plaintext communication is not supported.
-	@param imap_user: The username for SMTP authentication.
-	@param imap_pass: The password for SMTP authentication.
-	@param imap_spambox: The name of the spam mailbox, where the mail is also searched. Pass None to skip.
+	@param imap_port: The IMAP server port. STARTSSL or plaintext communication is not supported.
+	@param imap_user: The username for IMAP authentication.
+	@param imap_pass: The password for IMAP authentication.
+	@param mailbox: Name of the mailbox to select, such as INBOX or Junk.
+	@param readonly: Select the mailbox read-only, if no mails are going to be deleted.
+	@return Function returns an imaplib.IMAP4 object that represents a server connection.
+	"""
+
+	import imaplib
+
+	if server is not None:
+		try:
+			if server.noop()[0] == "OK":
+				return server
+		except (OSError, imaplib.IMAP4.error):
+			pass
+		debug(f"IMAP: Connection to {imap_host} was lost.")
+
+	return imap_connect(imap_host, imap_port, imap_user, imap_pass, mailbox, readonly)
+
+
+def imap_uid_marker(server: imaplib.IMAP4, state: Dict[str, List[int]], key: str) -> Optional[int]:
+	"""
+	Determine the lowest UID a newly delivered mail can have, based on the state of the previous check, and
+	update the state from the SELECT response of the mailbox. Mails with a lower UID were already in the
+	mailbox during the previous check and do not need to be searched again.
+
+	@param server: An imaplib.IMAP4 object that represents the sever connection. The mailbox must be selected.
+	@param state: The check state as returned by state_load(). It is updated in place.
+	@param key: Identifies the account and mailbox in the state.
+	@return Function returns the lowest UID to search or None to search the whole mailbox.
+	"""
+
+	previous = state.get(key)
+
+	# The values are only available right after SELECT. For a reused connection, the state is still valid.
+	typ, uidvalidity = server.response('UIDVALIDITY')
+	typ, uidnext = server.response('UIDNEXT')
+	if uidvalidity[0] is None or uidnext[0] is None:
+		return previous[1] if previous else None
+
+	state[key] = [int(uidvalidity[0]), int(uidnext[0])]
+
+	if previous and previous[0] == state[key][0]:
+		return previous[1]
+
+	if previous:
+		debug(f"IMAP: [{key}] UIDVALIDITY changed, searching the whole mailbox.")
+	return None
+
+
+class _StopEvent(threading.Event):
+	"""
+	Event that can also be waited for with select(), so that a watcher waiting in IDLE state wakes up as soon as
+	the event is set. Call close() after use.
+	"""
+
+	def __init__(self):
+		super().__init__()
+		self._reader, self._writer = socket.socketpair()
+
+	def set(self):
+		super().set()
+		self._writer.send(b"\0")
+
+	def fileno(self) -> int:
+		return self._reader.fileno()
+
+	def close(self) -> None:
+		self._reader.close()
+		self._writer.close()
+
+
+def imap_retrieve_mail(servers: Dict[str, imaplib.IMAP4], expected_token: str, cleanup_flag: bool,
+					   search_body: bool, min_uids: Optional[Dict[str, Optional[int]]] = None,
+					   found_uids: Optional[Dict[str, List[int]]] = None) -> MailFound:
+	"""
+	Retrieve an e-mail from an IMAP account. Search the INBOX and the Spambox for a specific token value.
+	All mailboxes are watched in parallel.
+
+	@param servers: Maps the mailbox names to look up, such as INBOX or Junk, to an imaplib.IMAP4 object
+		that has this mailbox selected. Each mailbox needs its own connection.
 	@param expected_token: Lookup this token in a X-Icinga-Test-Id E-mail header.
 	@param cleanup_flag: Remove mails from the IMAP account.
 	@param search_body: Search token in email body instead of header.
+	@param min_uids: Maps mailbox names to the lowest UID the mail may have, see imap_uid_marker().
+	@param found_uids: If given, the UIDs of the mails with the expected token are added to this dictionary,
+		which maps mailbox names to lists of UIDs.
 
 	@return Function returns a MailFound status.
 	"""
 
-	# Establish IMAP connection
-	server = imaplib.IMAP4_SSL(host=imap_host, port=imap_port, ssl_context=ssl.create_default_context())
-	debug(f"IMAP: Try to log in to {imap_host} as: {imap_user}")
-	server.login(imap_user, imap_pass)
-	debug(f"IMAP: Log in was successful.")
+	status = MailFound.NOT_FOUND
+	min_uids = min_uids or {}
+	found_uids = {} if found_uids is None else found_uids
+	for mailbox in servers:
+		found_uids.setdefault(mailbox, [])
+
+	# imaplib connections must not be shared between threads, thus each mailbox has its own connection.
+	# As the mail can only be in one mailbox, stop the other watchers as soon as it was found.
+	stop = _StopEvent()
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(servers)) as executor:
+			futures = [executor.submit(imap_watch_mailbox, server, mailbox, expected_token, cleanup_flag, search_body,
+									   min_uids.get(mailbox), stop, found_uids[mailbox])
+					   for mailbox, server in servers.items()]
+			try:
+				for future in concurrent.futures.as_completed(futures):
+					result = future.result()
+					if result != MailFound.NOT_FOUND:
+						status = result
+						break
+			finally:
+				stop.set()
+	finally:
+		stop.close()
+
+	return status
+
+
+def imap_watch_mailbox(server: imaplib.IMAP4, mailbox: str, expected_token: str, cleanup_flag: bool,
+					   search_body: bool, min_uid: Optional[int], stop: _StopEvent,
+					   found_uids: Optional[List[int]] = None) -> MailFound:
+	"""
+	Watch a single mailbox for a specific token value. Give up after delay * retries seconds.
+
+	@param server: An imaplib.IMAP4 object that represents the sever connection. The mailbox must be selected.
+	@param mailbox: Name of the mailbox, such as INBOX or Junk.
+	@param expected_token: Lookup this token in a X-Icinga-Test-Id E-mail header.
+	@param cleanup_flag: Remove mails from the IMAP account.
+	@param search_body: Search token in email body instead of header.
+	@param min_uid: Only search mails with this or a higher UID. Pass None to search the whole mailbox.
+	@param stop: Give up early once this event is set.
+	@param found_uids: If given, the UIDs of the mails with the expected token are appended to this list.
+
+	@return Function returns a MailFound status.
+	"""
 
 	status = MailFound.NOT_FOUND
+	idle_supported = "IDLE" in server.capabilities
 
-	# Check which mailboxes to lookup
-	mailboxes = ["INBOX"]
-	if imap_spambox:
-		debug(f"IMAP: Will also check spambox \"{imap_spambox}\" as fallback.")
-		mailboxes.append(imap_spambox)
-
-	for i in range(0, retries):
-		for mailbox in mailboxes:
-			time.sleep(delay)
-			status = imap_search_server(server, mailbox, expected_token, cleanup_flag, search_body)
-			if status != MailFound.NOT_FOUND:
-				server.logout()
-				return status
+	# Mail delivery usually takes much less than the configured delay. Thus, search right away and wait with
+	# an exponential backoff between the attempts until the time budget is used up.
+	deadline = time.monotonic() + delay * retries
+	wait = 0.5
+
+	while not stop.is_set():
+
+		status = imap_search_server(server, mailbox, expected_token, cleanup_flag, search_body, min_uid, found_uids)
+		if status != MailFound.NOT_FOUND:
+			break
+
+		remaining = deadline - time.monotonic()
+		if remaining <= 0:
+			break
+
+		# Wait for the mail. If the server supports IDLE, it notifies us about new mails.
+		if idle_supported:
+			new_mail = imap_idle(server, remaining, stop)
+			if new_mail is None:
+				debug(f"IMAP: [{mailbox}] Server rejected IDLE, falling back to polling.")
+				idle_supported = False
+			elif new_mail:
+				debug(f"IMAP: [{mailbox}] Server announced new mail.")
+
+		if not idle_supported:
+			stop.wait(min(wait, remaining))
+			wait = min(wait * 2, 5.0)
+
+			# The mailbox stays selected. NOOP makes the server report new mails instead of selecting it again.
+			if not stop.is_set():
+				server.noop()
 
-	server.logout()
 	return status
 
 
-def imap_search_server(server: imaplib.IMAP4, mailbox: str, expected_token: str, cleanup_flag: bool, search_body: bool) -> MailFound:
+def imap_idle(server: imaplib.IMAP4, timeout: float, stop: Optional[_StopEvent] = None) -> Optional[bool]:
+	"""
+	Wait for new mails in the selected mailbox using the IMAP IDLE command (RFC 2177).
+
+	@param server: An imaplib.IMAP4 object that represents the sever connection.
+	@param timeout: Maximum number of seconds to wait.
+	@param stop: Stop waiting early once this event is set.
+	@return Function returns True if the server announced a new mail, False on timeout and None if the server
+		rejected the IDLE command.
+	"""
+
+	# imaplib reads through a buffered file object, which hides already received lines from select(). Thus, read
+	# the responses during IDLE directly from the socket into an own line buffer.
+	buffer = b""
+
+	def read_line(wait: Optional[float], wakeup: bool = False) -> Optional[bytes]:
+		nonlocal buffer
+		while b"\r\n" not in buffer:
+			if not server.sock.pending():
+				waitables = [server.sock, stop] if wakeup and stop is not None else [server.sock]
+				if server.sock not in select.select(waitables, [], [], wait)[0]:
+					return None
+			data = server.sock.recv(4096)
+			if not data:
+				raise server.abort("IMAP: Connection closed during IDLE.")
+			buffer += data
+		line, _, buffer = buffer.partition(b"\r\n")
+		debug(f"IMAP: IDLE: {line}")
+		return line
+
+	def is_exists(line: bytes) -> bool:
+		return line.split()[2:3] == [b"EXISTS"]
+
+	tag = server._new_tag()
+	server.send(tag + b" IDLE\r\n")
+
+	# Wait for the continuation request. Mails delivered since the last search may already be announced before.
+	new_mail = False
+	while True:
+		line = read_line(None)
+		if line.startswith(b"+"):
+			break
+		if line.startswith(tag):
+			server.tagged_commands.pop(tag, None)
+			return None
+		new_mail = new_mail or is_exists(line)
+
+	deadline = time.monotonic() + timeout
+	while not new_mail and not (stop and stop.is_set()):
+		remaining = deadline - time.monotonic()
+		if remaining <= 0:
+			break
+		# The stop event wakes up select(), once another watcher found the mail.
+		line = read_line(remaining, wakeup=True)
+		if line is not None:
+			new_mail = is_exists(line)
+
+	# Leave IDLE state and consume everything up to the tagged response.
+	server.send(b"DONE\r\n")
+	while not read_line(None).startswith(tag):
+		pass
+	server.tagged_commands.pop(tag, None)
+
+	if buffer:
+		debug(f"IMAP: Ignoring unexpected data after IDLE: {buffer}")
+
+	return new_mail
+
+
+def imap_search_server(server: imaplib.IMAP4, mailbox: str, expected_token: str, cleanup_flag: bool, search_body: bool,
+					   min_uid: Optional[int] = None, found_uids: Optional[List[int]] = None) -> MailFound:
 	"""
 	Lookup token on IMAP server.
 
 	@param server: An imaplib.IMAP4 object that represents the sever connection.
-	@param mailbox: Name of the mailbox, such as INBOX or Junk.
+	@param mailbox: Name of the mailbox, such as INBOX or Junk. The mailbox must already be selected.
 	@param expected_token: Lookup this token in a X-Icinga-Test-Id E-mail header.
 	@param cleanup_flag: Remove mails from the IMAP account.
 	@param search_body: Search token in email body instead of header.
+	@param min_uid: Only search mails with this or a higher UID. Pass None to search the whole mailbox.
+	@param found_uids: If given, the UIDs of the mails with the expected token are appended to this list.
 	@return Function returns a MailFound status.
 	"""
 
-	class Email:
-		def __init__(self, _data):
-			self.data = _data.decode()
-			self.header = "\r\n\r\n".join(self.data.split("\r\n\r\n")[0:1])
-			self.body = "\r\n\r\n".join(self.data.split("\r\n\r\n")[2:])
-
 	token_found = MailFound.NOT_FOUND
-	token = ""
 
 	debug(f"IMAP: Check mail in mailbox {mailbox}.")
-	server.select(mailbox)
-
-	typ, data = server.search(None, 'ALL')
-	for num in data[0].split():
-
-		num_str = num.decode('utf-8')
 
-		typ, data = server.fetch(num, '(RFC822)')
-		debug(f"IMAP: [{mailbox}]:{num_str} Check mail {num_str}.")
-		email = Email(data[0][1])
-		if not search_body:
-			for line in email.header.splitlines():
+	# Let the server do the lookup instead of downloading every mail in the mailbox. Use UIDs, as message
+	# sequence numbers may change when other mails are delivered or expunged in the meantime.
+	criteria = ['UID', f'{min_uid}:*'] if min_uid else []
+	if not search_body:
+		typ, data = server.uid('SEARCH', *criteria, 'HEADER', 'X-Icinga-Test-Id', expected_token)
+	else:
+		typ, data = server.uid('SEARCH', *criteria, 'BODY', expected_token)
 
-				if line.startswith("X-Icinga-Test-Id"):
-					token = line.split("X-Icinga-Test-Id: ")[1].strip()
-					debug(f"IMAP: [{mailbox}]:{num_str} A token was found: {token}")
-		else:
-			for line in email.body.splitlines():
-
-				if line.startswith("X-Icinga-Test-Id"):
-					token = line.split("X-Icinga-Test-Id: ")[1].strip()
-					debug(f"IMAP: [{mailbox}]:{num_str} A token was found: {token}")
-
-		if token == expected_token:
-			debug(f"IMAP: [{mailbox}]:{num_str} Expected token {token} found in {mailbox}.")
-			if mailbox == "INBOX":
-				token_found = MailFound.FOUND
-				if cleanup_flag:
-					debug(f"IMAP: [{mailbox}]:{num_str} Mark mail {num_str} as deleted.")
-					server.store(num, '+FLAGS', '\\Deleted')
+	# SEARCH does a case-insensitive substring match, thus confirm the token on the hits. Only fetch the
+	# relevant part of the mail and use PEEK to not set the \Seen flag.
+	if not search_body:
+		fetch_item = '(BODY.PEEK[HEADER.FIELDS (X-Icinga-Test-Id)])'
+	else:
+		fetch_item = '(BODY.PEEK[TEXT])'
+
+	# Fetch the hits in batches instead of sending one command per mail. The mail was sent just now, thus start
+	# with the newest mails.
+	uids = data[0].split()[::-1]
+	to_delete = []
+	for i in range(0, len(uids), fetch_batch_size):
+
+		typ, fetched = server.uid('FETCH', b','.join(uids[i:i + fetch_batch_size]), fetch_item)
+
+		# imaplib returns (envelope, literal) tuples interleaved with b')' closers.
+		for j, item in enumerate(fetched):
+			if not isinstance(item, tuple):
+				continue
+
+			# The UID is usually reported before the literal, but may also follow it.
+			trailer = fetched[j + 1] if j + 1 < len(fetched) and isinstance(fetched[j + 1], bytes) else b""
+			uid_match = _UID_RE.search(item[0]) or _UID_RE.search(trailer)
+			if not uid_match:
+				continue
+
+			num = uid_match.group(1)
+			num_str = num.decode('utf-8')
+
+			debug(f"IMAP: [{mailbox}]:{num_str} Check mail {num_str}.")
+			match = _TOKEN_RE.search(item[1])
+			token = match.group(1).decode("utf-8", "replace") if match else ""
+			if token:
+				debug(f"IMAP: [{mailbox}]:{num_str} A token was found: {token}")
+
+			if token == expected_token:
+				debug(f"IMAP: [{mailbox}]:{num_str} Expected token {token} found in {mailbox}.")
+				if mailbox == "INBOX":
+					token_found = MailFound.FOUND
+				else:
+					token_found = MailFound.FOUND_IN_SPAM
+				if found_uids is not None:
+					found_uids.append(int(num))
+				if not cleanup_flag:
+					break
+				debug(f"IMAP: [{mailbox}]:{num_str} Mark mail {num_str} as deleted.")
+				to_delete.append(num)
 			else:
-				token_found = MailFound.FOUND_IN_SPAM
-				if cleanup_flag:
-					debug(f"IMAP: [{mailbox}]:{num_str} Mark mail {num_str} as deleted.")
-					server.store(num, '+FLAGS', '\\Deleted')
+				debug(f"IMAP: [{mailbox}]:{num_str} Expected token was not found in this e-mail.")
+
+		# Without cleanup, there is no need to look for further copies of the mail.
+		if token_found != MailFound.NOT_FOUND and not cleanup_flag:
 			break
-		else:
-			debug(f"IMAP: [{mailbox}]:{num_str} Expected token was not found in this e-mail.")
 
-	if cleanup_flag:
+	# Flag all matching mails with a single command.
+	if to_delete:
+		server.uid('STORE', b','.join(to_delete), '+FLAGS', '\\Deleted')
 		server.expunge()
-	server.close()
 
 	return token_found
 
 
-def main():
-	global debug_flag, delay, retries
+def state_load(path: str) -> Dict[str, List[int]]:
+	"""
+	Load the state of the previous check.
 
-	parser = argparse.ArgumentParser(description='Check SMTP to IMAPS health status.')
+	@param path: The state file. Pass an empty string to disable the state.
+	@return Function returns a dictionary that maps mailboxes to [UIDVALIDITY, UIDNEXT] pairs.
+	"""
 
-	parser.add_argument('--debug', action='store_true', help="Enable verbose output.")
-
-	parser.add_argument('--mail-from', metavar='MAIL_FROM', help='Mail: Use this sender address.', required=True)
-	parser.add_argument('--mail-to', metavar='MAIL_TO', help='Mail: Use this recipient address.', required=True)
-
-	parser.add_argument('--smtp-host', metavar='SMTP_HOST', help='SMTP: Hostname of the SMTP server.', required=True)
-	parser.add_argument('--smtp-port', metavar='SMTP_PORT',
-						help='SMTP: Deliver mail via this port. STARTSSL or plaintext communication is not supported.',
-						type=int, default=465)
-	parser.add_argument('--smtp-user', metavar='SMTP_USER', help='SMTP: User name for login.', required=True)
-	parser.add_argument('--smtp-pass', metavar='SMTP_PASS',
-						help='SMTP: Passwort for login. Alternatively, set environment variable SMTP_PASS.',
-						default=os.getenv("SMTP_PASS"))
-
-	parser.add_argument('--imap-host', metavar='IMAP_HOST', help='IMAP: Hostname of the SMTP server.', required=True)
-	parser.add_argument('--imap-port', metavar='IMAP_PORT', help='IMAP: Deliver mail via this port.', type=int,
-						default=993)
-	parser.add_argument('--imap-user', metavar='IMAP_USER', help='IMAP: User name for login.', required=True)
-	parser.add_argument('--imap-pass', metavar='IMAP_PASS',
-						help='IMAP: Passwort for login. Alternatively, set environment variable IMAP_PASS.',
-						default=os.getenv("IMAP_PASS"))
-	parser.add_argument('--imap-spam', metavar='IMAP_SPAM', help='IMAP: Name of the spam box.')
-	parser.add_argument('--imap-body', action='store_true', help='IMAP: Search token in body instead of header.')
-	parser.add_argument('--imap-cleanup', action='store_true', help="Delete processed mails on the IMAP account.")
-
-	parser.add_argument('--delay', metavar='SECONDS', help=f"Delay between sending and retrieving (default {delay} s).",
-						type=int, default=delay)
-	parser.add_argument('--retries', metavar='RETRIES', help=f"Token search attempts (default {retries}).",
-						type=int, default=retries)
-	args = parser.parse_args()
+	if not path:
+		return {}
+	try:
+		with open(path) as f:
+			state = json.load(f)
+	except (OSError, ValueError) as e:
+		debug(f"State: Cannot read {path}: {e}")
+		return {}
+
+	# A damaged or foreign file must not break the check. Fall back to searching the whole mailbox.
+	if not isinstance(state, dict) or not all(
+			isinstance(value, list) and len(value) == 2 and all(type(number) is int for number in value)
+			for value in state.values()):
+		debug(f"State: Ignoring invalid state in {path}.")
+		return {}
+	return state
+
+
+def state_save(path: str, state: Dict[str, List[int]]) -> None:
+	"""
+	Save the state for the next check. Errors are ignored, as the state is only an optimization.
 
-	debug_flag = args.debug
-	delay = args.delay
-	retries = args.retries
-	
-	_uuid = str(uuid.uuid4())
-	email = email_create_message(args.mail_from, args.mail_to, _uuid)
-	smtp_server = smtp_connect(args.smtp_host, args.smtp_port, args.smtp_user, args.smtp_pass)
-	smtp_server.sendmail(args.mail_from, args.mail_to, email.as_string())
-	debug(f"SMTP: Mail sent with ID {_uuid}.")
+	@param path: The state file. Pass an empty string to disable the state.
+	@param state: A dictionary that maps mailboxes to [UIDVALIDITY, UIDNEXT] pairs.
+	"""
 
-	status = imap_retrieve_mail(args.imap_host, args.imap_port, args.imap_user, args.imap_pass, args.imap_spam, _uuid,
-								args.imap_cleanup, args.imap_body)
+	import tempfile
+
+	if not path:
+		return
+	directory = os.path.dirname(path) or "."
+	try:
+		os.makedirs(directory, exist_ok=True)
+
+		# Other checks may share the file and save the state of their mailboxes at the same time. Keep their
+		# entries and write to a unique temporary file, so that concurrent saves do not corrupt each other.
+		merged = state_load(path)
+		merged.update(state)
+		fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "w") as f:
+				json.dump(merged, f)
+			os.replace(tmp_path, path)
+		except OSError:
+			os.unlink(tmp_path)
+			raise
+	except OSError as e:
+		debug(f"State: Cannot write {path}: {e}")
+
+
+def report(status: MailFound, daemon: bool = False) -> int:
+	"""
+	Print the check result.
+
+	@param status: The MailFound status of the check.
+	@param daemon: The check runs in daemon mode, which prints a result line for every status.
+	@return Function returns the plugin exit code.
+	"""
 
 	if status == MailFound.FOUND:
 		print("OK")
 		return 0
 	elif status == MailFound.FOUND_IN_SPAM:
-		debug("WARNING - Message found in Spam folder")
+		if daemon:
+			print("WARNING - Message found in Spam folder")
+		else:
+			debug("WARNING - Message found in Spam folder")
 		return 1
 	elif status == MailFound.NOT_FOUND:
 		print("ERROR - Message not found")
@@ -300,5 +720,238 @@ def main():
 		return 3
 
 
+def _options() -> Dict[str, dict]:
+	"""
+	Describe the command line options. Both parse_args() and parse_args_fast() are built from this table.
+
+	@return Function returns a dictionary that maps option names without the leading dashes to the keyword
+		arguments for argparse's add_argument().
+	"""
+
+	return {
+		'debug': dict(action='store_true', help="Enable verbose output."),
+
+		'mail-from': dict(metavar='MAIL_FROM', help='Mail: Use this sender address.', required=True),
+		'mail-to': dict(metavar='MAIL_TO', help='Mail: Use this recipient address.', required=True),
+
+		'smtp-host': dict(metavar='SMTP_HOST', help='SMTP: Hostname of the SMTP server.', required=True),
+		'smtp-port': dict(metavar='SMTP_PORT',
+						  help='SMTP: Deliver mail via this port. STARTSSL or plaintext communication is not supported.',
+						  type=int, default=465),
+		'smtp-user': dict(metavar='SMTP_USER', help='SMTP: User name for login.', required=True),
+		'smtp-pass': dict(metavar='SMTP_PASS',
+						  help='SMTP: Passwort for login. Alternatively, set environment variable SMTP_PASS.',
+						  default=os.getenv("SMTP_PASS")),
+
+		'imap-host': dict(metavar='IMAP_HOST', help='IMAP: Hostname of the SMTP server.', required=True),
+		'imap-port': dict(metavar='IMAP_PORT', help='IMAP: Deliver mail via this port.', type=int, default=993),
+		'imap-user': dict(metavar='IMAP_USER', help='IMAP: User name for login.', required=True),
+		'imap-pass': dict(metavar='IMAP_PASS',
+						  help='IMAP: Passwort for login. Alternatively, set environment variable IMAP_PASS.',
+						  default=os.getenv("IMAP_PASS")),
+		'imap-spam': dict(metavar='IMAP_SPAM', help='IMAP: Name of the spam box.'),
+		'imap-body': dict(action='store_true', help='IMAP: Search token in body instead of header.'),
+		'imap-cleanup': dict(action='store_true', help="Delete processed mails on the IMAP account."),
+		'state-file': dict(metavar='FILE',
+						   help=f"IMAP: Remember the last seen UIDs in this file, so that only new mails are searched. "
+								f"Pass an empty string to disable (default {state_file}).",
+						   default=state_file),
+
+		'delay': dict(metavar='SECONDS',
+					  help=f"Time to wait for the mail per retry. The token search gives up after DELAY * RETRIES "
+						   f"seconds (default {delay} s).",
+					  type=int, default=delay),
+		'retries': dict(metavar='RETRIES', help=f"Number of DELAY periods to wait for the mail (default {retries}).",
+						type=int, default=retries),
+
+		'daemon': dict(action='store_true',
+					   help="Keep running and repeat the check, reusing the SMTP and IMAP connections."),
+		'interval': dict(metavar='SECONDS', help=f"Daemon: Time between two checks (default {interval} s).",
+						 type=int, default=interval),
+	}
+
+
+def parse_args() -> argparse.Namespace:
+	"""
+	Parse the command line with argparse. This is the slow path, which also provides --help and error messages.
+
+	@return Function returns the parsed arguments.
+	"""
+
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Check SMTP to IMAPS health status.')
+	for name, kwargs in _options().items():
+		parser.add_argument('--' + name, **kwargs)
+	return parser.parse_args()
+
+
+def parse_args_fast(argv: List[str]) -> Optional[types.SimpleNamespace]:
+	"""
+	Parse the command line with getopt, which is much cheaper than setting up the argparse parser on every check.
+
+	@param argv: The command line arguments without the program name.
+	@return Function returns the parsed arguments like parse_args() or None if the command line needs the full
+		parser, for example to print the help or an error message.
+	"""
+
+	import getopt
+
+	if "-h" in argv or "--help" in argv:
+		return None
+
+	options = _options()
+	flags = [name for name, kwargs in options.items() if kwargs.get('action') == 'store_true']
+
+	try:
+		opts, rest = getopt.gnu_getopt(argv, "", [name if name in flags else name + "=" for name in options])
+	except getopt.GetoptError:
+		return None
+	if rest:
+		return None
+
+	args = {name: kwargs.get('default', False if name in flags else None) for name, kwargs in options.items()}
+	for opt, value in opts:
+		name = opt[2:]
+		if name in flags:
+			args[name] = True
+			continue
+
+		# argparse takes a value that starts with a dash for an option. Let it decide about such command lines.
+		if value.startswith("-"):
+			return None
+		try:
+			args[name] = options[name].get('type', str)(value)
+		except ValueError:
+			return None
+
+	if any(args[name] is None for name, kwargs in options.items() if kwargs.get('required')):
+		return None
+
+	return types.SimpleNamespace(**{name.replace("-", "_"): value for name, value in args.items()})
+
+
+def main():
+	global debug_flag, delay, retries
+
+	import imaplib
+	import smtplib
+
+	# Use the cheap getopt parser for the usual invocation by the monitoring system.
+	args = parse_args_fast(sys.argv[1:]) or parse_args()
+
+	debug_flag = args.debug
+	delay = args.delay
+	retries = args.retries
+
+	# Check which mailboxes to lookup
+	mailboxes = ["INBOX"]
+	if args.imap_spam:
+		debug(f"IMAP: Will also check spambox \"{args.imap_spam}\" as fallback.")
+		mailboxes.append(args.imap_spam)
+
+	# In daemon mode, the connections are kept open between the checks.
+	smtp_server = None
+	imap_servers = {mailbox: None for mailbox in mailboxes}
+
+	state = state_load(args.state_file)
+
+	while True:
+		_uuid = str(uuid.uuid4())
+		email = email_create_message(args.mail_from, args.mail_to, _uuid)
+
+		# Keep track of the connection an error came from. In daemon mode, only the failed connections are
+		# dropped, the others are reused by the next check.
+		smtp_error = None
+		imap_errors = {}
+
+		# Sending the mail and logging in to the IMAP server are independent of each other. Do both at the
+		# same time, so that the mailboxes are already selected when the mail arrives.
+		with concurrent.futures.ThreadPoolExecutor(max_workers=1 + len(mailboxes)) as executor:
+			smtp_future = executor.submit(smtp_reconnect, smtp_server, args.smtp_host, args.smtp_port,
+										  args.smtp_user, args.smtp_pass)
+			imap_futures = {mailbox: executor.submit(imap_reconnect, server, args.imap_host, args.imap_port,
+													 args.imap_user, args.imap_pass, mailbox, not args.imap_cleanup)
+							for mailbox, server in imap_servers.items()}
+
+			try:
+				smtp_server = smtp_future.result()
+				smtp_server.sendmail(args.mail_from, args.mail_to, email)
+				debug(f"SMTP: Mail sent with ID {_uuid}.")
+			except (OSError, smtplib.SMTPException) as e:
+				smtp_error = e
+
+			# Keep the sessions that logged in, even if another connection failed.
+			for mailbox, future in imap_futures.items():
+				try:
+					imap_servers[mailbox] = future.result()
+				except (OSError, imaplib.IMAP4.error) as e:
+					imap_errors[mailbox] = e
+
+		if smtp_error is None and not imap_errors:
+
+			# Only search mails that arrived since the previous check.
+			previous_state = dict(state)
+			keys = {mailbox: f"{args.imap_user}@{args.imap_host}/{mailbox}" for mailbox in imap_servers}
+			min_uids = {mailbox: imap_uid_marker(server, state, keys[mailbox])
+						for mailbox, server in imap_servers.items()}
+
+			found_uids = {}
+			try:
+				status = imap_retrieve_mail(imap_servers, _uuid, args.imap_cleanup, args.imap_body, min_uids,
+											found_uids)
+			except (OSError, imaplib.IMAP4.error) as e:
+				# The error does not tell which mailbox failed. The SMTP connection is not affected.
+				imap_errors = dict.fromkeys(imap_servers, e)
+			else:
+				result = report(status, args.daemon)
+
+				# A reused connection does not report UIDNEXT again. Advance the marker past the test mail
+				# instead, as later mails get higher UIDs.
+				for mailbox, uids in found_uids.items():
+					if uids and keys[mailbox] in state and max(uids) >= state[keys[mailbox]][1]:
+						state[keys[mailbox]] = [state[keys[mailbox]][0], max(uids) + 1]
+				if state != previous_state:
+					state_save(args.state_file, state)
+
+		errors = [e for e in [smtp_error, *imap_errors.values()] if e is not None]
+		if errors:
+			if not args.daemon:
+				raise errors[0]
+
+			# Keep the daemon running. The dropped connections are re-established by the next check.
+			print(f"UNKNOWN - Check failed: {errors[0]}")
+			result = 3
+			if smtp_error is not None and smtp_server is not None:
+				smtp_server.close()
+				smtp_server = None
+			for mailbox in imap_errors:
+				if imap_servers[mailbox] is not None:
+					try:
+						imap_servers[mailbox].shutdown()
+					except OSError:
+						pass
+					imap_servers[mailbox] = None
+
+		if not args.daemon:
+			break
+
+		# Stop the daemon with Ctrl-C between two checks. If it is interrupted during a check, the watcher
+		# threads may still use the IMAP connections, thus leave them to the interpreter shutdown.
+		sys.stdout.flush()
+		try:
+			time.sleep(args.interval)
+		except KeyboardInterrupt:
+			break
+
+	if smtp_server is not None:
+		smtp_server.close()
+	for server in imap_servers.values():
+		if server is not None:
+			imap_disconnect(server, args.imap_cleanup)
+
+	return result
+
+
 if __name__ == "__main__":
 	sys.exit(main())